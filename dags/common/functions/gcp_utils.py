@@ -1,13 +1,45 @@
+import functools
+import io
 import os
 
-from google.cloud import bigquery, storage
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery, bigquery_storage, storage
+
+# Arrow type for each BigQuery column type, used to cast data to the
+# schema of the table it is loaded into
+BQ_TO_ARROW_TYPES = {
+    'STRING': pa.string(),
+    'BYTES': pa.binary(),
+    'INTEGER': pa.int64(),
+    'INT64': pa.int64(),
+    'FLOAT': pa.float64(),
+    'FLOAT64': pa.float64(),
+    'NUMERIC': pa.decimal128(38, 9),
+    'BOOLEAN': pa.bool_(),
+    'BOOL': pa.bool_(),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+    'DATETIME': pa.timestamp('us'),
+    'DATE': pa.date32(),
+    'TIME': pa.time64('us')}
+
+# BigQuery Storage API read client, shared by all query-to-DataFrame and
+# query-to-Arrow calls. Constructed on first use so that importing this
+# module (e.g. during DAG parsing) does not open a gRPC channel.
+_bqstorage_client = None
 
 ########################################################################
 # Google BigQuery functions
 
+@functools.lru_cache(maxsize=None)
 def construct_bq_client(project_id):
     """ Constructs client for GCP BigQuery API
 
+    One client is constructed per project and reused on later calls.
+
     Args:
         project_id (string): name of project
 
@@ -20,22 +52,113 @@ def construct_bq_client(project_id):
     return bq_client
 
 
-def bq_query_to_df(bq_client, query):
+def get_bqstorage_client():
+    """ Returns the shared client for GCP BigQuery Storage API
+
+    The client is constructed on the first call and reused afterwards.
+
+    Returns:
+        client obj: client for GCP BigQuery Storage API
+    """
+
+    global _bqstorage_client
+
+    if _bqstorage_client is None:
+        _bqstorage_client = bigquery_storage.BigQueryReadClient()
+
+    return _bqstorage_client
+
+
+def bq_query_and_wait(bq_client, query, job_config=None):
+    """ Run query on BigQuery, wait for it and return the rows
+
+    Uses the jobs.query API, which lets BigQuery run short queries in
+    its optimised mode and returns the first page of results inline
+    rather than polling the job and then fetching results.
+
+    Args:
+        bq_client (client obj): client for GCP BigQuery API
+        query (str): query to be run on BigQuery
+        job_config (QueryJobConfig obj, optional): query configuration,
+            defaults to None
+
+    Returns:
+        RowIterator obj: results from query
+    """
+
+    rows = bq_client.query_and_wait(query, job_config=job_config)
+
+    return rows
+
+
+def bq_query_to_df(bq_client, query, max_stream_count=None, job_config=None):
     """ Run query on BigQuery and return Pandas DataFrame
 
+    Results that do not fit in the first page returned by jobs.query
+    are downloaded through the BigQuery Storage API as Arrow record
+    batches, which is much faster than the tabledata.list JSON path for
+    large results.
+
+    If max_stream_count is given, up to that many read streams are
+    consumed concurrently and the resulting batches are concatenated.
+    Row order is only preserved for queries with an ORDER BY clause, in
+    which case BigQuery serves the result over a single stream.
+
     Args:
         bq_client (client obj): client for GCP BigQuery API
         query (str): query to be run on BigQuery
+        max_stream_count (int, optional): max number of read streams,
+            defaults to None (let the library decide)
+        job_config (QueryJobConfig obj, optional): query configuration,
+            e.g. query parameters, defaults to None
 
     Returns:
         DataFrame: results from query
     """
 
-    df = bq_client.query(query).to_dataframe()
+    rows = bq_query_and_wait(bq_client, query, job_config)
+
+    if max_stream_count is None:
+        return rows.to_dataframe(
+            bqstorage_client=get_bqstorage_client(),
+            create_bqstorage_client=False)
+
+    df_list = list(rows.to_dataframe_iterable(
+        bqstorage_client=get_bqstorage_client(),
+        max_stream_count=max_stream_count))
+
+    # pd.concat raises on an empty list, so return an empty DataFrame
+    # with the result's columns instead
+    if len(df_list) == 0:
+        return pd.DataFrame(columns=[field.name for field in rows.schema])
+
+    df = pd.concat(df_list, ignore_index=True)
 
     return df
 
 
+def bq_query_to_arrow(bq_client, query, job_config=None):
+    """ Run query on BigQuery and return PyArrow Table
+
+    Use instead of bq_query_to_df when a Pandas DataFrame is not needed.
+
+    Args:
+        bq_client (client obj): client for GCP BigQuery API
+        query (str): query to be run on BigQuery
+        job_config (QueryJobConfig obj, optional): query configuration,
+            e.g. query parameters, defaults to None
+
+    Returns:
+        Table: results from query
+    """
+
+    table = bq_query_and_wait(bq_client, query, job_config).to_arrow(
+        bqstorage_client=get_bqstorage_client(),
+        create_bqstorage_client=False)
+
+    return table
+
+
 def bq_query_to_query_job(bq_client, query):
     """ Run query on BigQuery and return QueryJob
 
@@ -52,24 +175,154 @@ def bq_query_to_query_job(bq_client, query):
     return query_job
 
 
-def bq_df_to_table(bq_client, dataframe, table_id):
+def bq_get_table_schema(bq_client, table_id):
+    """ Gets the schema of a BigQuery table
+
+    Args:
+        bq_client (client obj): client for GCP BigQuery API
+        table_id (str): ID of table
+
+    Returns:
+        list: SchemaField obj for each column, or None if the table does
+            not exist
+    """
+
+    try:
+        schema = bq_client.get_table(table_id).schema
+    except NotFound:
+        schema = None
+
+    return schema
+
+
+def bq_create_table(bq_client, table_id, schema, expires=None):
+    """ Creates a BigQuery table if it does not exist
+
+    Args:
+        bq_client (client obj): client for GCP BigQuery API
+        table_id (str): ID of table
+        schema (list): SchemaField obj for each column
+        expires (datetime, optional): when the table is deleted,
+            defaults to None (never)
+
+    Returns:
+        Table obj: the created table, or the existing table if there is
+            one
+    """
+
+    table = bigquery.Table(table_id, schema=schema)
+    table.expires = expires
+    table = bq_client.create_table(table, exists_ok=True)
+
+    return table
+
+
+def arrow_to_bq_schema(table, schema):
+    """ Casts PyArrow Table to the schema of a BigQuery table
+
+    Columns are cast to the type of the schema field with the same name
+    and ordered as in the schema. Columns that are not in the schema, or
+    whose type has no Arrow equivalent, are left as they are. This e.g.
+    turns an all null column, which Arrow types as null, into the type
+    of the BigQuery column.
+
+    Args:
+        table (Table): data to be cast
+        schema (list): SchemaField obj for each column
+
+    Returns:
+        Table: data cast to schema
+    """
+
+    columns = {}
+    for field in schema:
+        if field.name not in table.column_names:
+            continue
+        column = table[field.name]
+        arrow_type = BQ_TO_ARROW_TYPES.get(field.field_type)
+        if arrow_type is not None and column.type != arrow_type:
+            column = pc.cast(column, options=pc.CastOptions(
+                target_type=arrow_type, allow_time_truncate=True))
+        columns[field.name] = column
+
+    # Keep any other columns, so the load reports them
+    for name in table.column_names:
+        if name not in columns:
+            columns[name] = table[name]
+
+    return pa.table(columns)
+
+
+def bq_df_to_table(
+    bq_client, dataframe, table_id, schema=None,
+    write_disposition=bigquery.WriteDisposition.WRITE_APPEND):
     """Load Pandas DataFrame into defined BigQuery table
 
+    The DataFrame is converted to a PyArrow Table and loaded with
+    bq_arrow_to_table.
+
     Args:
         bq_client (client obj): client for GCP BigQuery API
         dataframe (DataFrame): data to be loaded onto BigQuery
         table_id (str): ID of table for data to be loaded into
+        schema (list, optional): schema of the table, defaults to None
+            (fetched from BigQuery)
+        write_disposition (str, optional): what to do with existing rows,
+            defaults to WRITE_APPEND
     """
-    job = bq_client.load_table_from_dataframe(dataframe, table_id)
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+    bq_arrow_to_table(
+        bq_client, table, table_id, schema, write_disposition)
+    return
+
+
+def bq_arrow_to_table(
+    bq_client, table, table_id, schema=None,
+    write_disposition=bigquery.WriteDisposition.WRITE_APPEND):
+    """Load PyArrow Table into defined BigQuery table
+
+    The Table is written to an in-memory Snappy compressed Parquet file
+    and loaded in one job, without going through Pandas. If the table
+    exists, the data is first cast to its schema, as Parquet files carry
+    their own column types. Timestamps are written in microseconds, the
+    precision of BigQuery timestamps.
+
+    Args:
+        bq_client (client obj): client for GCP BigQuery API
+        table (Table): data to be loaded onto BigQuery
+        table_id (str): ID of table for data to be loaded into
+        schema (list, optional): schema of the table, defaults to None
+            (fetched from BigQuery)
+        write_disposition (str, optional): what to do with existing rows,
+            defaults to WRITE_APPEND
+    """
+    if schema is None:
+        schema = bq_get_table_schema(bq_client, table_id)
+    if schema is not None:
+        table = arrow_to_bq_schema(table, schema)
+
+    buf = io.BytesIO()
+    pq.write_table(table, buf, compression='snappy', coerce_timestamps='us',
+                   allow_truncated_timestamps=True)
+    buf.seek(0)
+
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=write_disposition)
+    job = bq_client.load_table_from_file(
+        buf, table_id, job_config=job_config)
     job.result() # Wait until job complete
     return
 
 ########################################################################
 # Google Cloud Storage functions
 
+@functools.lru_cache(maxsize=None)
 def construct_storage_client(project_id):
     """ Constructs client for GCP Cloud Storage API
 
+    One client is constructed per project and reused on later calls.
+
     Args:
         project_id (string): name of project
 
@@ -80,16 +333,25 @@ def construct_storage_client(project_id):
     return storage_client
 
 
-def cs_list_folder(storage_client, src_bucket, src_folder):
+def cs_list_folder(
+    storage_client, src_bucket, src_folder, name_prefix='',
+    max_results=None):
     """ Lists files in bucket (and optionally folder) on Cloud Storage
 
+    Files can be filtered by the start of their name, which is done by
+    Cloud Storage rather than by listing the whole location.
+
     Args:
         storage_client (client obj): client for GCP Cloud Storage API
         src_bucket (str): bucket name
         src_folder (str): folder name (use empty string for no folder)
+        name_prefix (str, optional): only list files whose name starts
+            with this, defaults to '' (all files)
+        max_results (int, optional): max number of files to list,
+            defaults to None (no limit)
 
-    Returns:
-        List: files in location
+    Yields:
+        str: relative path of each file in location
     """
 
     # If given folder name is not an empty string and does not have
@@ -101,17 +363,23 @@ def cs_list_folder(storage_client, src_bucket, src_folder):
     elif src_folder == '/':
         src_folder = ''
 
-    # Create list of file names within location
+    # Stream file names within location. Only the name field is
+    # requested so the API does not return (and the client does not
+    # parse) the rest of each object's metadata. The delimiter is kept so
+    # that files in sub folders are not listed.
     blobs = storage_client.list_blobs(src_bucket,
-                                        prefix=src_folder,
-                                        delimiter='/')
-    blob_list = [blob.name for blob in blobs if blob.name != src_folder]
-
-    return blob_list
+                                        prefix=src_folder + name_prefix,
+                                        delimiter='/',
+                                        fields='items(name),nextPageToken',
+                                        page_size=1000,
+                                        max_results=max_results)
+    for blob in blobs:
+        if blob.name != src_folder:
+            yield blob.name
 
 
 def cs_get_object_as_list(storage_client, src_bucket, blob_name):
-    """ List contents of file on Cloud Storage
+    """ List contents of file on Cloud Storage, one item per line
 
     Args:
         storage_client (client obj): client for GCP Cloud Storage API
@@ -124,10 +392,13 @@ def cs_get_object_as_list(storage_client, src_bucket, blob_name):
 
     bucket = storage_client.bucket(src_bucket)
     blob = bucket.blob(blob_name)
-    text = blob.download_as_text()
-    list = text.splitlines()
 
-    return list
+    # Read the file line by line in chunks rather than downloading it
+    # into a single string and then splitting it
+    with blob.open('rt') as file:
+        line_list = [line.rstrip('\r\n') for line in file]
+
+    return line_list
 
 
 def cs_move_object(
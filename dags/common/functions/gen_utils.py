@@ -1,10 +1,22 @@
 import configparser
+import functools
 import os
 
+# Directories of config and query files, relative to this file
+CONFIG_DIR = os.path.abspath(
+    os.path.join(os.path.dirname( __file__ ), '../../config'))
+SQL_DIR = os.path.abspath(
+    os.path.join(os.path.dirname( __file__ ), '../../sql'))
 
+
+@functools.lru_cache(maxsize=None)
 def read_config(config_file):
     """ Reads config file
 
+    The file is only read on the first call for each config file name.
+    Later calls return the same ConfigParser obj, which should not be
+    modified.
+
     Args:
         config_file (str): config file name
 
@@ -19,10 +31,7 @@ def read_config(config_file):
     config = configparser.ConfigParser()
 
     # Construct config path
-    levels = 2 * '../'
-    file_path = os.path.abspath(
-        os.path.join(
-            os.path.dirname( __file__ ), f'{levels}config/{config_file}'))
+    file_path = os.path.join(CONFIG_DIR, config_file)
 
     # Read config file
     config_list = config.read(file_path)
@@ -34,9 +43,12 @@ def read_config(config_file):
     raise OSError(2, 'Could not locate config file', config_file)
 
 
+@functools.lru_cache(maxsize=None)
 def read_query(query_file_name):
     """ Returns query in sql directory as a string
 
+    The file is only read on the first call for each query file name.
+
     Args:
         query_file_name (str): query file name
 
@@ -45,10 +57,7 @@ def read_query(query_file_name):
     """
 
     # Construct path to query file
-    levels = 2 * '../'
-    file_path = os.path.abspath(
-        os.path.join(
-            os.path.dirname( __file__ ), f'{levels}sql/{query_file_name}'))
+    file_path = os.path.join(SQL_DIR, query_file_name)
 
     # Read file and store as string
     with open(file_path, 'r') as file:
@@ -1,10 +1,28 @@
 from datetime import timedelta, datetime
-from airflow.models import DAG
+from airflow.models import DAG, Variable
 from airflow.operators.python_operator import PythonOperator, ShortCircuitOperator
 #from common.functions.gen_utils import read_config, read_query
 #from scripts.pl_uk_ip_piracy_report_traffic.pl_uk_ip_piracy_report_traffic import main as tmp_name
-from scripts.pl_uk_ip_piracy_report_detection.pl_uk_ip_piracy_report_detection import read_pl_fixtures, read_traffic, model_one
-import pandas as pd
+
+# The detection script (and the pandas/pyarrow stack it pulls in) is
+# imported inside the task callables, so scheduler parse passes do not pay
+# for it. get_parsing_context is only available from Airflow 2.4.
+try:
+    from airflow.utils.dag_parsing_context import get_parsing_context
+except ImportError:
+    get_parsing_context = None
+
+DAG_ID = 'pl_uk_ip_piracy_report_dag'
+
+# dag_id of the task being run, or None when the scheduler parses all DAGs
+if get_parsing_context is not None:
+    current_dag_id = get_parsing_context().dag_id
+else:
+    current_dag_id = None
+
+# Airflow Variables caching the fixture dates, and the modification time of the fixtures file they were read from
+FIXTURE_DATES_VAR = 'pl_fixture_dates'
+FIXTURE_DATES_MTIME_VAR = 'pl_fixture_dates_mtime'
 
 # Define DAG object
 args = {
@@ -15,11 +33,38 @@ args = {
     'retry_delay': timedelta(minutes=5),
 }
 
-dag = DAG(dag_id='pl_uk_ip_piracy_report_dag', default_args=args,
+dag = DAG(dag_id=DAG_ID, default_args=args,
           description='DAG to detect IPs infringing during pl matches',
           schedule_interval=timedelta(days=1))
 
 
+def get_fixture_dates():
+    """
+    Returns the set of premier league fixture dates. The dates are cached in an Airflow Variable and the fixtures are
+    only read again when the fixtures file has changed, so the check task does not load the whole fixtures table on
+    every run.
+
+    Returns:
+      set of fixture dates as 'YYYY-MM-DD' strings
+    """
+    from scripts.pl_uk_ip_piracy_report_detection.pl_uk_ip_piracy_report_detection import (pl_fixtures_mtime,
+                                                                                            read_pl_fixtures)
+
+    mtime = str(pl_fixtures_mtime())
+    if Variable.get(FIXTURE_DATES_MTIME_VAR, default_var=None) == mtime:
+        fixture_dates = Variable.get(FIXTURE_DATES_VAR, default_var=None, deserialize_json=True)
+    else:
+        fixture_dates = None
+
+    if fixture_dates is None:
+        pl_fixtures = read_pl_fixtures()
+        fixture_dates = sorted(pl_fixtures['date'].dt.strftime('%Y-%m-%d').unique().tolist())
+        Variable.set(FIXTURE_DATES_VAR, fixture_dates, serialize_json=True)
+        Variable.set(FIXTURE_DATES_MTIME_VAR, mtime)
+
+    return set(fixture_dates)
+
+
 def fixtures_check_func(**kwargs):
     """
     first task that just read a csv file of matchs time from bigquery and send a value to branch tasks,
@@ -38,14 +83,14 @@ def fixtures_check_func(**kwargs):
      Returns:
 
     """
-    pl_fixtures = read_pl_fixtures()
+    fixture_dates = get_fixture_dates()
 
     # execution_date shows the execution date for running dag.
     execution_date = datetime(2021, 4, 12)
     print('Airflow is running the ML algorithm')
 
     # check if there is a match on the execution date.
-    if (execution_date == pl_fixtures['date']).any():
+    if execution_date.strftime('%Y-%m-%d') in fixture_dates:
         cnd = 1
     else:
         cnd = -1
@@ -84,6 +129,8 @@ def ml_model_one_func(**kwargs):
     Args:
     Returns:
      """
+    from scripts.pl_uk_ip_piracy_report_detection.pl_uk_ip_piracy_report_detection import read_pl_fixtures, read_traffic, model_one
+
     # Create a file name ... Format of csv file name, which demonstrate todays date
     ip_traffic = read_traffic()
 
@@ -97,32 +144,35 @@ def ml_model_one_func(**kwargs):
     task_instance.xcom_push(key="Blob List", value=blob_list)
 
 
-# Define airflow operators
-fixtures_check_op = PythonOperator(
-    task_id='fixtures_check',
-    provide_context=True,
-    xcom_push=True,
-    python_callable=fixtures_check_func,
-    dag=dag)
-
-shrt_cr_op = ShortCircuitOperator(
-    task_id='skip_downstream',
-    provide_context=True,
-    python_callable=selector_func,
-    dag=dag)
-
-ml_model_one_op = PythonOperator(
-    task_id='ml_model_one',
-    provide_context=True,
-    xcom_push=True,
-    python_callable=ml_model_one_func,
-    dag=dag)
-
-# piracy_report_op = PythonOperator(
-#     task_id='piracy_report',
-#     provide_context=True,
-#     python_callable=tmp_name,
-#     dag=dag)
-
-# Define sequence of running task
-fixtures_check_op >> shrt_cr_op >> ml_model_one_op # >> piracy_report_op
\ No newline at end of file
+# Only define operators when parsing for all DAGs or for this DAG. When a
+# task of another DAG is being run, skip the rest of the file.
+if current_dag_id is None or current_dag_id == DAG_ID:
+    # Define airflow operators
+    fixtures_check_op = PythonOperator(
+        task_id='fixtures_check',
+        provide_context=True,
+        xcom_push=True,
+        python_callable=fixtures_check_func,
+        dag=dag)
+
+    shrt_cr_op = ShortCircuitOperator(
+        task_id='skip_downstream',
+        provide_context=True,
+        python_callable=selector_func,
+        dag=dag)
+
+    ml_model_one_op = PythonOperator(
+        task_id='ml_model_one',
+        provide_context=True,
+        xcom_push=True,
+        python_callable=ml_model_one_func,
+        dag=dag)
+
+    # piracy_report_op = PythonOperator(
+    #     task_id='piracy_report',
+    #     provide_context=True,
+    #     python_callable=tmp_name,
+    #     dag=dag)
+
+    # Define sequence of running task
+    fixtures_check_op >> shrt_cr_op >> ml_model_one_op # >> piracy_report_op
\ No newline at end of file
@@ -1,6 +1,10 @@
+import os
+
 import numpy as np
 import pandas as pd
-from sklearn import preprocessing
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 from datetime import datetime
 
 # Define config constants
@@ -9,6 +13,55 @@ SQL_PL_FIXTURES = "SQL_PL_FIXTURES.txt"
 SQL_IP_TRAFFICS = "SQL_IP_TRAFFICS.txt"
 
 CSVS_DIR = "~/Desktop/project/Archive/traffic and fixtures/"
+FIXTURES_FILE = "fixtures.csv"
+
+# Number of 5 minute time slots in a day
+SLOTS_PER_DAY = 288
+
+# Arrow CSV reader and writer options. Blocks are parsed in parallel and
+# columns with a known type skip type inference. Values are written
+# unquoted, as pandas does.
+CSV_READ_OPTIONS = pacsv.ReadOptions(use_threads=True, block_size=8 << 20)
+CSV_WRITE_OPTIONS = pacsv.WriteOptions(include_header=False, quoting_style='none')
+FIXTURES_COLUMN_TYPES = {'ko_time': pa.string()}
+TRAFFIC_COLUMN_TYPES = {
+    'bf_date': pa.date32(),
+    'bf_time': pa.string(),
+    'ip': pa.string(),
+    'gbps': pa.float32(),
+    'gbps_day': pa.float32(),
+}
+
+
+def read_csv(file_name, column_types):
+    """ Reads a csv file from CSVS_DIR into an Arrow Table
+
+      Args:
+      file_name (str): csv file name
+      column_types (dict): Arrow types for the columns that should not be inferred
+
+     Returns:
+         table (Table): contents of the csv file
+
+    """
+
+    table = pacsv.read_csv(
+        os.path.expanduser(CSVS_DIR + file_name),
+        read_options=CSV_READ_OPTIONS,
+        convert_options=pacsv.ConvertOptions(column_types=column_types))
+
+    return table
+
+
+def pl_fixtures_mtime():
+    """ Returns the modification time of the premier league fixtures file, so callers can tell when it has changed.
+
+     Returns:
+         mtime (float): modification time of the fixtures file in seconds since the epoch
+
+    """
+
+    return os.path.getmtime(os.path.expanduser(CSVS_DIR + FIXTURES_FILE))
 
 
 def read_pl_fixtures():
@@ -25,7 +78,7 @@ def read_pl_fixtures():
     """
 
     # Run the premier league fixtures query and convert the result to dataframe.
-    pl_fixtures = pd.read_csv(CSVS_DIR + "fixtures.csv")
+    pl_fixtures = read_csv(FIXTURES_FILE, FIXTURES_COLUMN_TYPES).to_pandas(self_destruct=True)
     pl_fixtures['date'] = pd.to_datetime(pl_fixtures['date'])
 
     return pl_fixtures
@@ -45,13 +98,68 @@ def read_traffic():
          ip_traffic (DataFrame): Traffic data for ds
 
     """
-    ip_traffic = pd.read_csv(CSVS_DIR + "tmp_traffic_20210412.csv")
-    ip_traffic = ip_traffic[ip_traffic['gbps_day'] > 1]
-    ip_traffic = ip_traffic.sort_values(['bf_date', 'ip', 'bf_time'], ascending=[True, True, True])
+    ip_traffic = read_csv("tmp_traffic_20210412.csv", TRAFFIC_COLUMN_TYPES)
+
+    # Filter and sort with Arrow compute before converting to pandas, so only the kept rows are materialized
+    ip_traffic = ip_traffic.filter(pc.greater(ip_traffic['gbps_day'], 1))
+    ip_traffic = ip_traffic.sort_by([('bf_date', 'ascending'), ('ip', 'ascending'), ('bf_time', 'ascending')])
+    ip_traffic = ip_traffic.to_pandas(self_destruct=True)
+
+    # Store ips as integer category codes, so grouping and pivoting on ip does not hash strings
+    ip_traffic['ip'] = ip_traffic['ip'].astype('category')
+
+    # 5 minute slot of the day (0 to 287) of each bf_time, so model_one can index time with integers
+    ip_traffic['slot'] = (ip_traffic['bf_time'].str.slice(0, 2).astype(np.int16) * 12 +
+                          ip_traffic['bf_time'].str.slice(3, 5).astype(np.int16) // 5)
 
     return ip_traffic
 
 
+def smooth_and_diff(arr, window=8, periods=4):
+    """ Smooths and differentiates the traffic of each ip (column) in a single pass. This is equivalent to
+    DataFrame.rolling(window).mean().shift(-periods).diff(periods) but builds one cumulative sum instead of three
+    full size intermediate frames. The intermediates are column-major, like the array model_one passes in.
+
+     Args:
+      arr (ndarray): 2D array of traffic, one row per time slot and one column per ip
+      window (int): size of the moving average window
+      periods (int): shift applied to the moving average and periods of the difference
+     Returns:
+         out (ndarray): smoothed and differentiated traffic, NaN where the window or difference is incomplete
+
+    """
+
+    n = arr.shape[0]
+    m = max(n - periods, 0)
+
+    # moving average ending at each row, from a float64 cumulative sum to limit rounding errors
+    csum = np.zeros((n + 1, arr.shape[1]), order='F')
+    np.cumsum(arr, axis=0, dtype=np.float64, out=csum[1:])
+    ma = np.full(arr.shape, np.nan, order='F')
+    ma[window - 1:] = (csum[window:] - csum[:-window]) / window
+
+    # the shifted average at row t is ma[t + periods], so its difference over periods rows is ma[t + periods] - ma[t]
+    out = np.full(arr.shape, np.nan, dtype=arr.dtype, order='F')
+    out[:m] = ma[periods:] - ma[:m]
+
+    return out
+
+
+def write_ip_list(ip_list, blob_name):
+    """ Writes a list of identified ips as a csv file in the local result directory.
+
+      Args:
+      ip_list (Table): identified ips, single 'ip' column
+      blob_name (str): csv file name
+
+    """
+
+    # Arrow always quotes the header, so it is written here to match the pandas output
+    with open(os.path.expanduser(CSVS_DIR + 'result/' + blob_name), 'wb') as f:
+        f.write(b'ip\n')
+        pacsv.write_csv(ip_list, f, write_options=CSV_WRITE_OPTIONS)
+
+
 def model_one(ip_traffic, pl_fixtures, match_date):
     """ This function applies the ML model one (an algorithm designed based on the rate of rise of the traffic on ip
     level) for each premier league matches to detect potential infringing ips. The detected ips are separately saved
@@ -61,62 +169,53 @@ def model_one(ip_traffic, pl_fixtures, match_date):
       ip_traffic (DataFrame): Traffic data for ds
       pl_fixtures (DataFrame): Premier league fixtures for the current season
       match_date (str): the execution date
-      BUCKET_NAME (str): storage bucket name
      Returns:
          ip_traffic (DataFrame): Traffic data for ds
 
     """
 
     # create a dictionary of game dates and times
-    pl_games = {}
-    match_dates = list(set(pl_fixtures['date']))
+    pl_games = pl_fixtures.groupby('date')['ko_time'].unique().to_dict()
 
     match_date = pd.to_datetime(match_date)
 
-    for md in match_dates:
-        pl_games[md] = list(pl_fixtures[pl_fixtures['date'] == md]['ko_time'].unique())
-
-    # Normalizing, Smoothing and Differentiating the traffic per ip
-    ip_traffic = ip_traffic.loc[:, ['bf_time', 'ip', 'gbps']]
-    ip_pivot = pd.pivot_table(ip_traffic, values='gbps', index=['bf_time'], columns=['ip'], aggfunc=np.sum)
+    # Normalizing, Smoothing and Differentiating the traffic per ip. Every slot of the day gets a row, so that row i of
+    # the pivot is slot i.
+    ip_traffic = ip_traffic.loc[:, ['slot', 'ip', 'gbps']]
+    ip_pivot = ip_traffic.groupby(['slot', 'ip'], observed=True)['gbps'].sum().unstack('ip', fill_value=0)
+    ip_pivot = ip_pivot.reindex(range(SLOTS_PER_DAY), fill_value=0)
 
     # filter out non top-talker ips
-    ip_pivot = ip_pivot[ip_pivot.columns[ip_pivot.max() > 0.02]]
-    ip_pivot = ip_pivot.fillna(0)
-    ips = ip_pivot[ip_pivot.columns[:]]
-    ips = ips.T
-
-    # minmax normalization
-    ips_normalized = preprocessing.minmax_scale(ips.T).T
-    ips_normalized = pd.DataFrame(ips_normalized.T)
-    ips_normalized.columns = ip_pivot.columns[:]
-    ips_normalized.index = ip_pivot.index
-
-    ips_smoothed = ips_normalized.groupby(ips_normalized.index).mean().rolling(window=8).mean().shift(periods=-4)
-    ips_d = ips_smoothed.diff(periods=4)
-
-    match_times_idx = []
-    for match_time in range(len(pl_games[match_date])):
-        s_idx = 12 * int(pl_games[match_date][match_time][0:2]) + int(pl_games[match_date][match_time][3:5]) / 5 - 6
-        e_idx = 12 * int(pl_games[match_date][match_time][0:2]) + int(pl_games[match_date][match_time][3:5]) / 5 + 21
-        match_times_idx.append(s_idx)
-        match_times_idx.append(e_idx)
+    ip_pivot = ip_pivot.loc[:, ip_pivot.max(axis=0) > 0.02]
+
+    # From here on the traffic is a column-major float32 array, so each ip's time series is contiguous in memory
+    arr = np.asfortranarray(ip_pivot.to_numpy(dtype=np.float32))
+
+    # minmax normalization of each ip over time (constant ips are scaled to 0)
+    arr_min = arr.min(axis=0)
+    arr_max = arr.max(axis=0)
+    arr_range = np.where(arr_max > arr_min, arr_max - arr_min, 1)
+    ips_normalized = (arr - arr_min) / arr_range
+
+    ips_d = smooth_and_diff(ips_normalized)
+
+    # start and end slot of the analysis window of each game
+    ko_times = pd.Series(pl_games[match_date], dtype=str)
+    ko_slots = 12 * ko_times.str.slice(0, 2).astype(int).to_numpy() + ko_times.str.slice(3, 5).astype(int).to_numpy() // 5
+    windows = list(zip(ko_slots - 6, ko_slots + 21))
 
     # Save identified ips in google storage (bigquery) for each pl game
-    count = 0
     blob_list = list()
-    for match_time in range(len(pl_games[match_date])):
-        ip_pirate_list = (ips_d[int(match_times_idx[count]):int(match_times_idx[count + 1])] > .1).sum()
-        ip_pirate_list = ip_pirate_list[ip_pirate_list > 10].sort_values(ascending=False)
-        ip_pirate_list = pd.DataFrame(ip_pirate_list.index.get_level_values(0))
+    for (s_idx, e_idx), ko_time in zip(windows, pl_games[match_date]):
+        # count the time slots of the game where each ip rises, and keep the ips with more than 10, most first
+        counts = (ips_d[s_idx:e_idx] > .1).sum(axis=0)
+        mask = counts > 10
+        order = np.argsort(-counts[mask], kind='stable')
+        ip_pirate_list = pa.table({'ip': ip_pivot.columns.to_numpy()[mask][order]})
 
         # write the identified ip list in the google storage
-        blob_name = 'ips_' + (str(match_date).split()[0]).replace('-','') + "_" + str(pl_games[match_date][match_time]).replace(':','')[0:4] + "_UTC.csv"
-        pd.DataFrame(data=ip_pirate_list).to_csv(path_or_buf=CSVS_DIR + 'result/' + blob_name, index=False, encoding="UTF-8")
-
-        # move to the next game for the current match date
+        blob_name = 'ips_' + (str(match_date).split()[0]).replace('-','') + "_" + str(ko_time).replace(':','')[0:4] + "_UTC.csv"
+        write_ip_list(ip_pirate_list, blob_name)
         blob_list += [blob_name]
-        del ip_pirate_list
-        count += 2
 
     return blob_list
\ No newline at end of file
@@ -1,29 +1,80 @@
 import argparse
+import collections
 import datetime as dt
 import os
+import re
+import threading
+import uuid
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
 
+import numpy as np
 from dateutil.parser import parse
+from google.cloud import bigquery
 
 from common.exceptions.custom_exceptions import (BigQueryError,
                                                  CloudStorageError)
-from common.functions.gcp_utils import (bq_df_to_table, bq_query_to_df,
-                                        bq_query_to_query_job,
+from common.functions.gcp_utils import (bq_create_table, bq_df_to_table,
+                                        bq_get_table_schema,
+                                        bq_query_and_wait, bq_query_to_df,
                                         construct_bq_client,
                                         construct_storage_client,
                                         cs_get_object_as_list, cs_list_folder,
                                         cs_move_object)
 from common.functions.gen_utils import read_config, read_query
 
+# Offsets of the analysis windows from kick off. The noise window runs
+# from 1.5hrs to 0.5hrs before kick off and the game window from kick
+# off to 110 mins after it.
+_NOISE_START_OFFSET = dt.timedelta(minutes=-90)
+_NOISE_END_OFFSET = dt.timedelta(minutes=-30)
+_GAME_END_OFFSET = dt.timedelta(minutes=110)
+
+# Name of the IP files written by pl_uk_ip_piracy_report_detection, e.g.
+# ips_20210814_1500_UTC.csv, and the format of the ko timestamp in it
+_IP_FILE_NAME_RE = re.compile(r'ips_(\d{8}_\d{4})_UTC\.csv')
+_IP_FILE_KO_FORMAT = '%Y%m%d_%H%M'
+
+# Start and end timestamps of the analysis windows for one kick off
+Windows = collections.namedtuple(
+    'Windows', ['noise_start', 'noise_end', 'game_start', 'game_end'])
+
+# Schema of the match ip traffic table, used to create it on the first
+# run. Later runs use the schema of the existing table, see
+# get_match_ip_traffic_schema.
+MATCH_IP_TRAFFIC_SCHEMA = [
+    bigquery.SchemaField('ip', 'STRING'),
+    bigquery.SchemaField('asn', 'INTEGER'),
+    bigquery.SchemaField('as_name', 'STRING'),
+    bigquery.SchemaField('analyse', 'INTEGER'),
+    bigquery.SchemaField('vpn', 'BOOLEAN'),
+    bigquery.SchemaField('vpn_name', 'STRING'),
+    bigquery.SchemaField('season', 'STRING'),
+    bigquery.SchemaField('game_week', 'INTEGER'),
+    bigquery.SchemaField('ko_timestamp', 'TIMESTAMP'),
+    bigquery.SchemaField('timestamp', 'TIMESTAMP'),
+    bigquery.SchemaField('gigabits', 'FLOAT'),
+    bigquery.SchemaField('piracy_gigabits', 'FLOAT'),
+    bigquery.SchemaField('gbps', 'FLOAT'),
+    bigquery.SchemaField('piracy_gbps', 'FLOAT')]
+
+# Temp tables expire after this, in case they are not deleted
+_TMP_TABLE_EXPIRY = dt.timedelta(hours=1)
+
+# Concurrent DML statements on one table can fail with serialization
+# errors, so the files' merges into the table are run one at a time
+_MERGE_LOCK = threading.Lock()
+
 ########################################################################
 # Data processing functions
 
 def get_ips(storage_client, src_bucket, src_folder, input_file_name):
     """ Gets a list of IPs from a csv file in GCP Cloud Storage
 
-    This functions scans all the files in the defined bucket (and
-    optionally folder) on GCP's Cloud Storage. If there's a matching
+    This functions lists the files in the defined bucket (and optionally
+    folder) on GCP's Cloud Storage whose name starts with the file name,
+    so only candidate files are returned. If there's a matching
     file, it returns that file's relative path in the bucket and the
     list of IPs that the file contains. If there are no files in the
     defined location, there is no matching file, or there are multiple
@@ -45,22 +96,31 @@ def get_ips(storage_client, src_bucket, src_folder, input_file_name):
         list: list of IPs from the file
     """
 
-    # List contents of defined bucket or folder within bucket
-    blob_list = cs_list_folder(storage_client, src_bucket, src_folder)
-
-    # If there is nothing in the bucket or folder, raise error
-    if len(blob_list) == 0:
-        raise CloudStorageError(
-            f'No IP files in:\nBucket: {src_bucket}\nFolder: {src_folder}')
-
-    # Iterate through list of files and store those that match the
-    # input_file_name arg
+    # List files in defined bucket or folder within bucket whose name
+    # starts with input_file_name and store those that match it. Names
+    # are listed in order, so an exact match comes before any longer
+    # names and 2 results are enough.
     blob_to_process = []
-    for blob_name in blob_list:
+    for blob_name in cs_list_folder(
+            storage_client,
+            src_bucket,
+            src_folder,
+            name_prefix=input_file_name,
+            max_results=2):
         blob_basename = os.path.basename(blob_name)
         if blob_basename == input_file_name:
             blob_to_process.append(blob_name)
 
+    # If there is no match and nothing in the bucket or folder, raise
+    # error. This is only checked when there is no match. 2 results are
+    # listed as the first may be the folder placeholder object, which
+    # cs_list_folder skips.
+    if len(blob_to_process) == 0 and next(
+            cs_list_folder(storage_client, src_bucket, src_folder,
+                max_results=2), None) is None:
+        raise CloudStorageError(
+            f'No IP files in:\nBucket: {src_bucket}\nFolder: {src_folder}')
+
     # Raise error if no matching files or multiple matching files.
     # Otherwise, get list of IPs from file.
     if len(blob_to_process) == 0:
@@ -77,13 +137,33 @@ def get_ips(storage_client, src_bucket, src_folder, input_file_name):
     return blob_to_process[0], ip_list
 
 
-def get_ip_traffic(bq_client, query_file_name, ip_tuple, ko_timestamp):
-    """ Queries BQ using query with substituted IPs and analysis period
+def get_windows(ko_timestamp):
+    """ Gets the noise and game windows for the kick off timestamp
 
-    This function gets the detected ips traffic query from file and
-    substitutes into it the given ip_tuple arg and analysis period
-    relative to the given ko_timestamp arg. The query is then run on
-    BigQuery and a Pandas Dataframe is returned.
+    Args:
+        ko_timestamp (datetime): timestamp of kick off in UTC
+
+    Returns:
+        Windows: start and end timestamps of the noise and game windows
+    """
+
+    windows = Windows(
+        noise_start=ko_timestamp + _NOISE_START_OFFSET,
+        noise_end=ko_timestamp + _NOISE_END_OFFSET,
+        game_start=ko_timestamp,
+        game_end=ko_timestamp + _GAME_END_OFFSET)
+
+    return windows
+
+
+def get_ip_traffic(bq_client, query, ip_list, windows):
+    """ Queries BQ using query with parameterised IPs and analysis period
+
+    This function runs the detected ips traffic query on BigQuery with
+    the given ip_list arg and the analysis period, from the start of the
+    noise window to the end of the game window, as query parameters. A
+    Pandas Dataframe is returned. As the query text is the same for
+    every call, BigQuery can reuse cached results.
 
     The query floors timestamps to 5 min intervals i.e. 00:00:00 ->
     00:04:59 = 00:00:00, summing the gigabits transferred over the 5 min
@@ -91,26 +171,25 @@ def get_ip_traffic(bq_client, query_file_name, ip_tuple, ko_timestamp):
 
     Args:
         bq_client (client obj): client for GCP BigQuery API
-        query_file_name (str): file name of the query
-        ip_tuple (tuple): the IPs traffic data should be returned for
-        ko_timestamp (datetime): timestamp of kick off in UTC
+        query (str): detected ips traffic query
+        ip_list (list): the IPs traffic data should be returned for
+        windows (Windows): noise and game windows from get_windows
 
     Returns:
         DataFrame: Traffic data for IPs within analysis period
     """
 
-    # Get query and store string
-    query_str = read_query(query_file_name)
-
-    # Substitute in values
-    query_template = Template(query_str)
-    query = query_template.substitute(
-        analysis_start = ko_timestamp + dt.timedelta(minutes=-90),
-        analysis_end   = ko_timestamp + dt.timedelta(minutes=110),
-        ip_tuple       = ip_tuple)
+    # Set query parameters
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter('ips', 'STRING', ip_list),
+        bigquery.ScalarQueryParameter('analysis_start', 'TIMESTAMP',
+            windows.noise_start),
+        bigquery.ScalarQueryParameter('analysis_end', 'TIMESTAMP',
+            windows.game_end)])
 
     # Run query
-    input_ip_traffic_df =  bq_query_to_df(bq_client, query)
+    input_ip_traffic_df =  bq_query_to_df(
+        bq_client, query, job_config=job_config)
 
     return input_ip_traffic_df
 
@@ -125,28 +204,66 @@ def check_ips_and_warn(src_bucket, blob_name, ip_list, input_ip_traffic_df):
         input_ip_traffic_df (DataFrame): new data to check IPs for
     """
 
-    missing_ips = set(ip_list) - set(input_ip_traffic_df['ip'])
+    missing_ips = set(ip_list).difference(
+        input_ip_traffic_df['ip'].unique())
     if len(missing_ips) > 0:
         warnings.warn(
-        f'{blob_name} in {src_bucket} no traffic data for IPs: {missing_ips}')
+        f'{blob_name} in {src_bucket} no traffic data for IPs: '
+        f'{missing_ips}')
 
     return
 
 
-def get_season_and_gw(bq_client, query_file_name, ko_timestamp):
-    """ Gets the season and game week for the kick off timestamp
+def get_seasons_and_gws(bq_client, query_template, ko_timestamp_list):
+    """ Gets the seasons and game weeks for a list of kick off timestamps
 
-    This function gets the season and game week query from file and
-    substitutes into it the ko_timestamp arg. The query is then run on
-    BigQuery and the season and game week matching the ko timestamp is
-    returned.
+    This function substitutes the ko_timestamp_list arg into the season
+    and game week query template. The query is then run
+    on BigQuery once for all kick off timestamps, and the seasons and
+    game weeks matching each ko timestamp are returned.
 
     Args:
         bq_client (client obj): client for GCP BigQuery API
-        query_file_name (str): file name of the query
+        query_template (Template obj): season and game week query
+        ko_timestamp_list (list): timestamps of kick offs in UTC
+
+    Returns:
+        dict: list of [season, game_week] matches for each ko timestamp,
+            keyed by the ko timestamp as a string
+    """
+
+    # Nothing to look up, and an empty IN list is invalid SQL
+    if len(ko_timestamp_list) == 0:
+        return {}
+
+    # Substitute in values
+    query = query_template.substitute(ko_timestamps = ', '.join(
+        f"'{ko_timestamp}'" for ko_timestamp in ko_timestamp_list))
+
+    # Run query
+    rows = bq_query_and_wait(bq_client, query)
+
+    # Group matches by ko timestamp. Keys are strings so that they match
+    # the ko timestamps whether match_time_utc is a TIMESTAMP or a STRING
+    # column.
+    season_gw_dict = {}
+    for row in rows:
+        season_gw_dict.setdefault(str(row['match_time_utc']), []).append(
+            [row['season'], row['game_week']])
+
+    return season_gw_dict
+
+
+def get_season_and_gw(season_gw_dict, ko_timestamp):
+    """ Gets the season and game week for the kick off timestamp
+
+    Args:
+        season_gw_dict (dict): seasons and game weeks from
+            get_seasons_and_gws
         ko_timestamp (datetime): timestamp of kick off in UTC
 
     Raises:
+        BigQueryError: if no game week matches ko_timestamp
         BigQueryError: if multiple game weeks match ko_timestamp
 
     Returns:
@@ -154,18 +271,7 @@ def get_season_and_gw(bq_client, query_file_name, ko_timestamp):
         int: the game week matching the ko timestamp
     """
 
-    # Get query and store string
-    query_str = read_query(query_file_name)
-
-    # Substitute in values
-    query_template = Template(query_str)
-    query = query_template.substitute(ko_timestamp = ko_timestamp)
-
-    # Run query
-    query_job = bq_query_to_query_job(bq_client, query)
-
-    # Convert QueryJob to list
-    query_list = [[row['season'], row['game_week']] for row in query_job]
+    query_list = season_gw_dict.get(str(ko_timestamp), [])
 
     # If the query result list is 0 (no matching game week) or more then
     # 1 (multiple matching game weeks) raise an error
@@ -177,7 +283,8 @@ def get_season_and_gw(bq_client, query_file_name, ko_timestamp):
         return query_list[0][0], int(query_list[0][1])
 
 
-def construct_output_df(ko_timestamp, season, gw, input_ip_traffic_df):
+def construct_output_df(
+        ko_timestamp, season, gw, input_ip_traffic_df, windows):
     """ Cleans and processes the input DF, and constructs the output DF
 
     This function cleans and processes the input DataFrame. It
@@ -195,6 +302,7 @@ def construct_output_df(ko_timestamp, season, gw, input_ip_traffic_df):
     Args:
         ko_timestamp (datetime): timestamp of kick off in UTC
         input_ip_traffic_df (DataFrame): traffic data
+        windows (Windows): noise and game windows from get_windows
 
     Returns:
         DataFrame: output IP traffic DataFrame to be loaded into BQ
@@ -202,17 +310,20 @@ def construct_output_df(ko_timestamp, season, gw, input_ip_traffic_df):
 
     #### Create the base DataFrame
     # This DataFrame contains the IP, asn info, and kick off timestamp
-    # for the IP traffic data to be joined to. The chain sorts by asn
-    # with na values first and then drops duplicates keeping the last
-    # values. This creates a distinct DataFrame of IPs with asn info.
+    # for the IP traffic data to be joined to. The chain flags records
+    # without asn data, stable sorts on that int8 flag alone so records
+    # with asn data come first, and then drops duplicate IPs keeping the
+    # first values. This creates a distinct DataFrame of IPs with asn
+    # info without sorting on the IP strings.
     # Creating this df and rejoining the traffic data to it is required
     # due to issues in the bigflow data where, for one IP, some records
     # have asn data and some do not.
     base_df = (input_ip_traffic_df
         [['ip', 'asn', 'as_name', 'analyse', 'vpn', 'vpn_name']].
-        sort_values('asn', na_position='first').
-        drop_duplicates(subset=['ip'], keep='last').
-        convert_dtypes().
+        assign(no_asn=input_ip_traffic_df['asn'].isna().astype('int8')).
+        sort_values('no_asn', kind='stable').
+        drop_duplicates(subset=['ip'], keep='first').
+        drop(columns='no_asn').
         set_index('ip'))
     base_df['season'] = season
     base_df['game_week'] = gw
@@ -225,100 +336,194 @@ def construct_output_df(ko_timestamp, season, gw, input_ip_traffic_df):
     # some record have asn data and some do not. This results in the
     # detected_ips_traffic_query returning one IP record with asn data
     # and one IP record without asn data within a single 5 min
-    # timestamp.
+    # timestamp. Grouping by timestamp first leaves the rows sorted by
+    # timestamp, so the time windows below can be found by binary search.
     clean_ip_traffic_df = (input_ip_traffic_df
         [['timestamp', 'ip', 'gigabits']].
-        groupby(['ip', 'timestamp']).
+        groupby(['timestamp', 'ip']).
         sum().
         reset_index())
 
+    # Row ranges of the noise window and the game window
+    noise_start, noise_end, game_start, game_end = (clean_ip_traffic_df
+        ['timestamp'].
+        searchsorted(list(windows)))
+
     #### Calculate noise
     # Noise is calculated as the mean traffic for each IP from 1.5hrs
     # before the game to 0.5hrs before the game.
     # Calculate noise for each IP
-    noise_df = (clean_ip_traffic_df
-        [(clean_ip_traffic_df['timestamp'] >=
-            ko_timestamp + dt.timedelta(minutes=-90)) &
-        (clean_ip_traffic_df['timestamp'] <
-            ko_timestamp + dt.timedelta(minutes=-30))]
-        [['ip', 'gigabits']].
-        groupby('ip').
+    noise_gigabits = (clean_ip_traffic_df.
+        iloc[noise_start:noise_end].
+        groupby('ip', sort=False)
+        ['gigabits'].
         # Calculates the mean gigabits transferred per 5 mins for each
         # IP over the 1 hour. There are 12 5min intervals in 1 hour.
         # This method is used instead of a standard mean as IPs might be
         # missing records for some of the 12 timestamps.
-        agg(lambda x: x.sum()/12).
-        rename({'gigabits': 'noise_gigabits'}, axis=1))
-
-    # Join noise value for each IP to traffic data on IP
-    processed_ip_traffic_df = (clean_ip_traffic_df
-        [(clean_ip_traffic_df["timestamp"] >= ko_timestamp) &
-        (clean_ip_traffic_df["timestamp"] <
-            ko_timestamp + dt.timedelta(minutes=110))].
-        merge(noise_df, how='left', on='ip').
-        # If no noise data, fill with 0s
-        fillna(value={'noise_gigabits': 0}))
+        sum().
+        div(12))
+
+    # Look up noise value for each IP in the traffic data. There is one
+    # noise value per IP, so this is a map rather than a join.
+    processed_ip_traffic_df = (clean_ip_traffic_df.
+        iloc[game_start:game_end].
+        assign(noise_gigabits=lambda df: df['ip'].
+            map(noise_gigabits).
+            # If no noise data, fill with 0s
+            fillna(0)))
 
     #### Calculate piracy gigabits
-    # Subtract noise gigabits from total gigabits to get piracy gigabits
-    processed_ip_traffic_df['piracy_gigabits'] = (
-        (processed_ip_traffic_df['gigabits'] -
-            processed_ip_traffic_df['noise_gigabits']).
-        clip(lower = 0)) # This stops any 'negative' piracy
+    # Subtract noise gigabits from total gigabits to get piracy gigabits.
+    # Calculated on the underlying arrays, clipping at 0 in place to stop
+    # any 'negative' piracy.
+    gigabits = processed_ip_traffic_df['gigabits'].to_numpy(
+        dtype=np.float64)
+    piracy_gigabits = gigabits - processed_ip_traffic_df[
+        'noise_gigabits'].to_numpy(dtype=np.float64)
+    np.maximum(piracy_gigabits, 0.0, out=piracy_gigabits)
+    processed_ip_traffic_df['piracy_gigabits'] = piracy_gigabits
 
     #### Calculate gbps
     # For each IP calculate gbps for each 5min timestamp
-    processed_ip_traffic_df['gbps'] = (processed_ip_traffic_df
-        ['gigabits'].
-        div(300)) # 5 mins
+    processed_ip_traffic_df['gbps'] = gigabits * (1 / 300) # 5 mins
 
     #### Calculate piracy gbps
     # For each IP calculate piracy gbps for each 5min timestamp
-    processed_ip_traffic_df['piracy_gbps'] = (processed_ip_traffic_df
-        ['piracy_gigabits'].
-        div(300)) # 5 mins
+    processed_ip_traffic_df['piracy_gbps'] = (
+        piracy_gigabits * (1 / 300)) # 5 mins
 
     #### Construct output DataFrame
-    # Join processed IP traffic to the base DataFrame
-    output_ip_traffic_df = base_df.merge(
-        processed_ip_traffic_df[['timestamp', 'ip', 'gigabits',
-        'piracy_gigabits', 'gbps', 'piracy_gbps']], on='ip')
-    output_ip_traffic_df.reset_index()
+    # Join processed IP traffic to the base DataFrame, which is already
+    # indexed by IP
+    output_ip_traffic_df = (base_df.
+        merge(processed_ip_traffic_df[['timestamp', 'ip', 'gigabits',
+            'piracy_gigabits', 'gbps', 'piracy_gbps']],
+            left_index=True, right_on='ip').
+        reset_index(drop=True))
+    # Keep IP as the first column, matching the table
+    output_ip_traffic_df.insert(0, 'ip', output_ip_traffic_df.pop('ip'))
 
     return output_ip_traffic_df
 
 
-def bq_delete_existing_rows(
-        bq_client, query_file_name, ko_timestamp, table_id):
-    """ Deletes rows in table with matching kick off timestamp
+def get_match_ip_traffic_schema(bq_client, table_id):
+    """ Gets the schema of the match ip traffic table
+
+    The table is created with MATCH_IP_TRAFFIC_SCHEMA if it does not
+    exist yet.
+
+    Args:
+        bq_client (client obj): client for GCP BigQuery API
+        table_id (str): id of the table in BQ
+
+    Returns:
+        list: SchemaField obj for each column
+    """
+
+    schema = bq_get_table_schema(bq_client, table_id)
+    if schema is None:
+        schema = bq_create_table(
+            bq_client, table_id, MATCH_IP_TRAFFIC_SCHEMA).schema
+
+    return schema
+
+
+def bq_replace_ko_rows(
+        bq_client, query_template, output_ip_traffic_df, ko_timestamp,
+        table_id, schema):
+    """ Replaces rows in table with matching kick off timestamp
+
+    The output DataFrame is loaded into a temp table with the table's
+    schema, which is then merged into the table in one query. The merge
+    deletes any existing rows with a matching kick off timestamp and
+    inserts the new rows atomically. The temp table is always deleted
+    afterwards, and expires if that fails.
 
     Args:
         bq_client (client obj): client for GCP BigQuery API
-        query_file_name (str): file name of the query
+        query_template (Template obj): merge match ip traffic query
+        output_ip_traffic_df (DataFrame): data to be loaded onto BigQuery
         ko_timestamp (datetime): timestamp of kick off in UTC
         table_id (str): id of the table in BQ
+        schema (list): schema of the table from
+            get_match_ip_traffic_schema
     """
 
-    # Get query and store string
-    query_str = read_query(query_file_name)
+    # Unique temp table, so concurrent or leftover runs cannot share it
+    tmp_table_id = (f'{table_id}_tmp_{int(ko_timestamp.timestamp())}_'
+        f'{uuid.uuid4().hex}')
 
-    # Substitute in values
-    query_template = Template(query_str)
+    # Substitute in tables, which cannot be query parameters
     query = query_template.substitute(
-        table_id       = table_id,
-        ko_timestamp   = ko_timestamp)
+        table_id = table_id, tmp_table_id = tmp_table_id)
 
-    # Run query
-    bq_query_to_df(bq_client, query)
+    # Set query parameters
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter(
+            'ko_timestamp', 'TIMESTAMP', ko_timestamp)])
+
+    try:
+        # Create temp table with the table's schema, so the merge inserts
+        # columns of the right types in the right order
+        bq_create_table(
+            bq_client,
+            tmp_table_id,
+            schema,
+            dt.datetime.now(dt.timezone.utc) + _TMP_TABLE_EXPIRY)
+
+        # Load output DataFrame into the empty temp table. A truncating
+        # load would replace the temp table's schema with the file's.
+        bq_df_to_table(
+            bq_client,
+            output_ip_traffic_df,
+            tmp_table_id,
+            schema,
+            bigquery.WriteDisposition.WRITE_EMPTY)
+
+        # Run query
+        with _MERGE_LOCK:
+            bq_query_and_wait(bq_client, query, job_config)
+    finally:
+        bq_client.delete_table(tmp_table_id, not_found_ok=True)
 
     return
 
 ########################################################################
 # Input processing
 
+def read_queries(config):
+    """ Reads the queries and builds the query templates used per file
+
+    Args:
+        config (ConfigParser obj): parsed config data
+
+    Raises:
+        FileNotFoundError: if can't locate a query file
+
+    Returns:
+        dict: detected_ips_traffic_query (str),
+            season_and_game_week_query (Template obj) and
+            merge_match_ip_traffic_query (Template obj)
+    """
+
+    queries = {
+        'detected_ips_traffic_query': read_query(
+            config['BIGQUERY']['detected_ips_traffic_query']),
+        'season_and_game_week_query': Template(read_query(
+            config['BIGQUERY']['season_and_game_week_query'])),
+        'merge_match_ip_traffic_query': Template(read_query(
+            config['BIGQUERY']['merge_match_ip_traffic_query']))}
+
+    return queries
+
+
 def parse_and_check_tz(file_name):
     """ Parse timestamp and ensure in UTC
 
+    File names in the format written by the detection script are parsed
+    with strptime. Any other file name falls back to a fuzzy parse.
+
     Args:
         file_name (str): the file name to be processed
 
@@ -329,7 +534,13 @@ def parse_and_check_tz(file_name):
         datetime: timestamp in UTC
     """
 
-    # Parse timestamp
+    # Parse timestamp, using the fast path for known file names
+    match = _IP_FILE_NAME_RE.fullmatch(file_name)
+    if match is not None:
+        return dt.datetime.strptime(
+            match.group(1), _IP_FILE_KO_FORMAT).replace(
+                tzinfo=dt.timezone.utc)
+
     ko_timestamp = parse(file_name, fuzzy=True)
 
     # If no TZ info raise error
@@ -381,6 +592,118 @@ def get_file_name_w_ko(dev, **context):
 ########################################################################
 # Main function
 
+def process_file(
+        input_file_name, ko_timestamp, bq_client, storage_client, config,
+        queries, season_gw_dict, table_schema):
+    """ Processes one IP file and loads its traffic into BigQuery
+
+    The IP file is not moved here, see move_processed_files.
+
+    Args:
+        input_file_name (str): the file name to be processed
+        ko_timestamp (datetime): timestamp of kick off in UTC
+        bq_client (client obj): client for GCP BigQuery API
+        storage_client (client obj): client for GCP Cloud Storage API
+        config (ConfigParser obj): parsed config data
+        queries (dict): queries and query templates from read_queries
+        season_gw_dict (dict): seasons and game weeks from
+            get_seasons_and_gws
+        table_schema (list): schema of the match ip traffic table from
+            get_match_ip_traffic_schema
+
+    Returns:
+        str: relative path of the processed IP file in the bucket
+    """
+
+    # For log
+    print(f'{input_file_name}: Extracting IPs from file')
+
+    # Get IP file name and list of IPs to be processed
+    blob_name, ip_list = get_ips(
+        storage_client,
+        config['CLOUD_STORAGE']['src_bucket'],
+        config['CLOUD_STORAGE']['src_folder'],
+        input_file_name)
+
+    # For log
+    print(f'{input_file_name}: Getting traffic data')
+
+    # Get the analysis windows for the ko timestamp
+    windows = get_windows(ko_timestamp)
+
+    # Get traffic data for IPs for match period
+    input_ip_traffic_df = get_ip_traffic(
+        bq_client,
+        queries['detected_ips_traffic_query'],
+        ip_list,
+        windows)
+
+    # Check for missing IPs in input_ip_traffic_df against original list
+    check_ips_and_warn(
+        config['CLOUD_STORAGE']['src_bucket'],
+        blob_name,
+        ip_list,
+        input_ip_traffic_df)
+
+    # Get the season and game week for the ko timestamp
+    season, gw = get_season_and_gw(season_gw_dict, ko_timestamp)
+
+    # For log
+    print(f'{input_file_name}: Constructing output DataFrame')
+
+    # Construct output DataFrame
+    output_ip_traffic_df = construct_output_df(
+        ko_timestamp,
+        season,
+        gw,
+        input_ip_traffic_df,
+        windows)
+
+    # For log
+    print(f'{input_file_name}: Loading DataFrame into table')
+
+    # Replace any existing data in table for ko timestamp with the output
+    # DataFrame
+    bq_replace_ko_rows(
+        bq_client,
+        queries['merge_match_ip_traffic_query'],
+        output_ip_traffic_df,
+        ko_timestamp,
+        config['BIGQUERY']['match_ip_traffic_table_id'],
+        table_schema)
+
+    return blob_name
+
+
+def move_processed_files(executor, storage_client, config, blob_list):
+    """ Moves processed IP files to the processed location
+
+    All moves are dispatched to the thread pool at once rather than one
+    after the other.
+
+    Args:
+        executor (ThreadPoolExecutor obj): thread pool to move files in
+        storage_client (client obj): client for GCP Cloud Storage API
+        config (ConfigParser obj): parsed config data
+        blob_list (list): relative paths of the IP files in the bucket
+
+    Returns:
+        list: Future obj for the move of each file
+    """
+
+    futures = [
+        executor.submit(
+            cs_move_object,
+            storage_client,
+            config['CLOUD_STORAGE']['src_bucket'],
+            blob_name,
+            config['CLOUD_STORAGE']['dst_bucket'],
+            config['CLOUD_STORAGE']['dst_folder'])
+        for blob_name in blob_list]
+
+    return futures
+
+
 def main(dev=False, **context):
     """ Function for program execution
 
@@ -388,7 +711,7 @@ def main(dev=False, **context):
         dev (bool, optional): set True if developing, defaults False
 
     Raises:
-        FileNotFoundError: if can't locate delete_rows_by_ko_query
+        FileNotFoundError: if can't locate a query file
     """
 
     # For log
@@ -409,8 +732,8 @@ def main(dev=False, **context):
     print('project_id: {}'.format(config['BIGQUERY']['project_id']))
     print('detected_ips_traffic_query: {}'.format(
         config['BIGQUERY']['detected_ips_traffic_query']))
-    print('delete_rows_by_ko_query: {}'.format(
-        config['BIGQUERY']['delete_rows_by_ko_query']))
+    print('merge_match_ip_traffic_query: {}'.format(
+        config['BIGQUERY']['merge_match_ip_traffic_query']))
     print('season_and_game_week_query: {}'.format(
         config['BIGQUERY']['season_and_game_week_query']))
     print('match_ip_traffic_table_id: {}\n'.format(
@@ -424,111 +747,94 @@ def main(dev=False, **context):
         # For log
         print('Using dev Google application credentials')
 
+    # Read queries once for all files
+    queries = read_queries(config)
+
     # For log
     print('Constructing clients')
 
-    # Construct client
-    bq_client = construct_bq_client(config['CLOUD_STORAGE']['project_id'])
+    # Construct clients
+    bq_client = construct_bq_client(config['BIGQUERY']['project_id'])
     storage_client = construct_storage_client(
-        config['BIGQUERY']['project_id'])
+        config['CLOUD_STORAGE']['project_id'])
 
     # For log
-    print('\nBeginning processing loop\n')
-
-    # Iterate through files
-    for input_file_name, ko_timestamp in file_name_w_ko_list:
+    print('Matching ko timestamps to seasons and game weeks')
 
-        # For log
-        print('------------------------------------------------------------')
-        print(f'Processing {input_file_name}')
-        print('Extracting IPs from file')
-
-        # Get IP file name and list of IPs to be processed
-        blob_name, ip_list = get_ips(
-            storage_client,
-            config['CLOUD_STORAGE']['src_bucket'],
-            config['CLOUD_STORAGE']['src_folder'],
-            input_file_name)
-
-        # For log
-        print('Getting traffic data')
+    # Get the seasons and game weeks for all ko timestamps in one query
+    season_gw_dict = get_seasons_and_gws(
+        bq_client,
+        queries['season_and_game_week_query'],
+        [ko_timestamp for _, ko_timestamp in file_name_w_ko_list])
 
-        # Get traffic data for IPs for match period
-        input_ip_traffic_df = get_ip_traffic(
-            bq_client,
-            config['BIGQUERY']['detected_ips_traffic_query'],
-            tuple(ip_list),
-            ko_timestamp)
-
-        # Check for missing IPs in input_ip_traffic_df against original list
-        check_ips_and_warn(
-            config['CLOUD_STORAGE']['src_bucket'],
-            blob_name,
-            ip_list,
-            input_ip_traffic_df)
-
-        # For log
-        print('Matching ko timestamp to season and game week')
-
-        # Get the season and game week for the ko timestamp
-        season, gw = get_season_and_gw(
-            bq_client,
-            config['BIGQUERY']['season_and_game_week_query'],
-            ko_timestamp)
-
-        # For log
-        print('Constructing output DataFrame')
+    # For log
+    print('Getting match ip traffic table schema')
 
-        # Construct output DataFrame
-        output_ip_traffic_df = construct_output_df(
-            ko_timestamp,
-            season,
-            gw,
-            input_ip_traffic_df)
+    # Get the table schema once for all files, creating the table if it
+    # does not exist yet
+    table_schema = get_match_ip_traffic_schema(
+        bq_client, config['BIGQUERY']['match_ip_traffic_table_id'])
 
-        # For log
-        print('Deleting any existing data in table for ko timestamp')
+    # For log
+    print('\nBeginning processing loop\n')
+    print('------------------------------------------------------------')
 
-        # For ko_timestamp, if data already exists in table, delete
-        # existing rows. BQ raises an error if the table doesn't
-        # exist, hence try/except.
-        try:
-            bq_delete_existing_rows(
-                bq_client,
-                config['BIGQUERY']['delete_rows_by_ko_query'],
+    # Process files concurrently. Each file is independent and most of
+    # the time is spent waiting on Cloud Storage and BigQuery. The clients
+    # are thread-safe and shared by all workers.
+    max_workers = max(1, min(8, len(file_name_w_ko_list)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                process_file,
+                input_file_name,
                 ko_timestamp,
-                config['BIGQUERY']['match_ip_traffic_table_id'])
-        except FileNotFoundError as error:
-            raise error
-        except:
-            pass
-
-        # For log
-        print('Loading DataFrame into table')
-
-        # Create BQ table of output DataFrame
-        bq_df_to_table(
-            bq_client,
-            output_ip_traffic_df,
-            config['BIGQUERY']['match_ip_traffic_table_id'])
+                bq_client,
+                storage_client,
+                config,
+                queries,
+                season_gw_dict,
+                table_schema)
+            for input_file_name, ko_timestamp in file_name_w_ko_list]
+
+        # Log the outcome of each file and collect the errors, so the
+        # task still fails if any file could not be processed
+        errors = []
+        processed_file_list = []
+        processed_blob_list = []
+        for (input_file_name, _), future in zip(
+                file_name_w_ko_list, futures):
+            error = future.exception()
+            if error is None:
+                print(f'{input_file_name}: Processed')
+                processed_file_list.append(input_file_name)
+                processed_blob_list.append(future.result())
+            else:
+                print(f'{input_file_name}: Failed with {error!r}')
+                errors.append(error)
 
         # For log
-        print('Moving IP file')
+        print('Moving processed IP files')
 
-        # Move IP file to processed location
-        cs_move_object(
-            storage_client,
-            config['CLOUD_STORAGE']['src_bucket'],
-            blob_name,
-            config['CLOUD_STORAGE']['dst_bucket'],
-            config['CLOUD_STORAGE']['dst_folder'])
+        # Move processed IP files to processed location in one pass
+        move_futures = move_processed_files(
+            executor, storage_client, config, processed_blob_list)
 
-        # For log
-        print('Complete')
+    for input_file_name, future in zip(processed_file_list, move_futures):
+        error = future.exception()
+        if error is None:
+            print(f'{input_file_name}: Complete')
+        else:
+            print(f'{input_file_name}: Failed to move with {error!r}')
+            errors.append(error)
 
     print('------------------------------------------------------------')
     print('Loop complete')
 
+    # Raise the first error
+    if len(errors) > 0:
+        raise errors[0]
+
     return
 
 
@@ -1,8 +1,8 @@
   -- Last Updated : 2021-08-10
   -- Author       : Greg Mungall
   -- Description  : Run as part of pl_uk_ip_piracy_report_traffic. Gets traffic
-  -- from bigflow for a list of IPs between two dates. IPs and dates inserted
-  -- programatically by pl_uk_ip_piracy_report_traffic.py.
+  -- from bigflow for a list of IPs between two dates. IPs and dates passed as
+  -- query parameters by pl_uk_ip_piracy_report_traffic.py.
 
 #standardSQL
 
@@ -37,11 +37,11 @@ ON
   ipv4_src_addr = ip
 WHERE
   exporter_ipv4_address IN (SELECT ip FROM refdata.routers WHERE IS_PT)
-  AND _partitiontime >= TIMESTAMP_TRUNC(TIMESTAMP '$analysis_start', DAY)
-  AND _partitiontime <= TIMESTAMP_TRUNC(TIMESTAMP '$analysis_end', DAY)
-  AND FIRST_SWITCHED >= TIMESTAMP '$analysis_start'
-  AND FIRST_SWITCHED < TIMESTAMP '$analysis_end'
-  AND ipv4_src_addr IN $ip_tuple
+  AND _partitiontime >= TIMESTAMP_TRUNC(@analysis_start, DAY)
+  AND _partitiontime <= TIMESTAMP_TRUNC(@analysis_end, DAY)
+  AND FIRST_SWITCHED >= @analysis_start
+  AND FIRST_SWITCHED < @analysis_end
+  AND ipv4_src_addr IN UNNEST(@ips)
 GROUP BY
   timestamp,
   ip,
@@ -0,0 +1,20 @@
+  -- Last Updated : 2021-08-10
+  -- Author       : Greg Mungall
+  -- Description  : Run as part of pl_uk_ip_piracy_report_traffic. Replaces
+  -- rows in table with matching KO timestamp by the rows in the temp table in
+  -- one atomic MERGE. The temp table has the same schema as the table. Tables
+  -- inserted programatically and KO timestamp passed as a query parameter by
+  -- pl_uk_ip_piracy_report_traffic.py.
+
+#standardSQL
+
+MERGE
+  `$table_id` AS t
+USING
+  `$tmp_table_id` AS s
+ON
+  FALSE
+WHEN NOT MATCHED BY SOURCE AND t.ko_timestamp = @ko_timestamp THEN
+  DELETE
+WHEN NOT MATCHED THEN
+  INSERT ROW;
@@ -1,19 +1,21 @@
   -- Last Updated : 2021-08-11
   -- Author       : Greg Mungall
   -- Description  : Run as part of pl_uk_ip_piracy_report_traffic. Gets season
-  -- and game week for KO timestamp. KO timestamp inserted programatically by
-  -- pl_uk_ip_piracy_report_traffic.py.
+  -- and game week for a list of KO timestamps. KO timestamps inserted
+  -- programatically by pl_uk_ip_piracy_report_traffic.py.
 
   #standardSQL
 
 SELECT
+  match_time_utc,
   season,
   game_week
 FROM
   `stone-flux-161611.refdata.fixtures`
 WHERE
-  match_time_utc = '$ko_timestamp'
+  match_time_utc IN ($ko_timestamps)
   AND type = 'PL'
 GROUP BY
+  match_time_utc,
   season,
   game_week
\ No newline at end of file